@@ -4,9 +4,24 @@ RAG Evaluation Script
 Evaluates RAG system using RAGAS framework
 """
 
-import json
+import hashlib
+import os
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+from itertools import zip_longest
+
+import ijson
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from langchain_core.callbacks import BaseCallbackHandler
 from ragas import evaluate
+from ragas.embeddings.base import BaseRagasEmbeddings, embedding_factory
+from ragas.run_config import RunConfig
 from ragas.metrics import (
     faithfulness,
     answer_relevancy,
@@ -16,30 +31,225 @@ from ragas.metrics import (
     answer_similarity,
     answer_correctness
 )
-from datasets import Dataset
+from datasets import Dataset, Features, Sequence, Value
+from datasets.builder import DatasetGenerationError
+
+# Same as the RAGAS default; override to match the endpoint's rate limits
+MAX_WORKERS = int(os.environ.get("RAGAS_MAX_WORKERS", "16"))
+
+# Embeddings kept in the LRU cache (~25 MB at 1536 float32 dims); hits come
+# from metrics scoring the same row, which run close together
+EMBEDDING_CACHE_SIZE = 4096
+
+# Bytes per read() when streaming evaluation_data.json
+READ_BUFFER_SIZE = 1024 * 1024
+
+# evaluation_data.json key -> RAGAS dataset column
+FIELDS = {
+    'questions': 'question',
+    'answers': 'answer',
+    'contexts': 'contexts',
+    'ground_truths': 'ground_truth'
+}
+
+# Metrics that compare against ground_truth and are meaningless without it
+REFERENCE_METRICS = [
+    context_precision,
+    context_recall,
+    context_entity_recall,
+    answer_similarity,
+    answer_correctness
+]
+
+# Placeholder for values past the end of a shorter column
+MISSING = object()
+
+# Arrow schema for the generated dataset. Value types are checked in
+# check_sample_types; this mainly keeps an all-null ground_truth column
+# typed as string rather than null
+FEATURES = Features({
+    'question': Value('string'),
+    'answer': Value('string'),
+    'contexts': Sequence(Value('string')),
+    'ground_truth': Value('string')
+})
+
+class CachedEmbeddings(BaseRagasEmbeddings):
+    """Embeddings wrapper with a bounded LRU keyed by SHA-256 of the input text"""
+    
+    def __init__(self, embeddings, max_size=EMBEDDING_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.run_config = embeddings.run_config
+    
+    @staticmethod
+    def _key(text):
+        return hashlib.sha256(text.encode()).digest()
+    
+    def _get(self, key):
+        vector = self.cache.get(key)
+        if vector is not None:
+            self.cache.move_to_end(key)
+        return vector
+    
+    def _store(self, key, vector):
+        # float32 arrays take ~4x less memory than lists of Python floats
+        vector = np.asarray(vector, dtype=np.float32)
+        self.cache[key] = vector
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return vector
+    
+    def _lookup(self, texts):
+        # Cached vectors by key, plus deduplicated texts still to embed
+        keys = [self._key(text) for text in texts]
+        vectors = {key: self._get(key) for key in keys}
+        missing = {key: text for key, text in zip(keys, texts) if vectors[key] is None}
+        return keys, vectors, missing
+    
+    def embed_query(self, text):
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is None:
+            vector = self._store(key, self.embeddings.embed_query(text))
+        return vector.tolist()
+    
+    def embed_documents(self, texts):
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            embedded = self.embeddings.embed_documents(list(missing.values()))
+            for key, vector in zip(missing, embedded):
+                vectors[key] = self._store(key, vector)
+        return [vectors[key].tolist() for key in keys]
+    
+    async def aembed_query(self, text):
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is None:
+            vector = self._store(key, await self.embeddings.aembed_query(text))
+        return vector.tolist()
+    
+    async def aembed_documents(self, texts):
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            embedded = await self.embeddings.aembed_documents(list(missing.values()))
+            for key, vector in zip(missing, embedded):
+                vectors[key] = self._store(key, vector)
+        return [vectors[key].tolist() for key in keys]
+
+class MetricLatencyCallback(BaseCallbackHandler):
+    """Record wall-clock latency of every metric x sample RAGAS run"""
+    
+    def __init__(self, metric_names):
+        self.metric_names = set(metric_names)
+        self.rows = set()
+        self.started = {}
+        self.latencies = defaultdict(list)
+    
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        name = (serialized or {}).get('name') or kwargs.get('name', '')
+        if name.startswith('row '):
+            self.rows.add(run_id)
+        # Only direct children of a row, so answer_correctness' nested
+        # answer_similarity call is not counted twice
+        elif name in self.metric_names and parent_run_id in self.rows:
+            self.started[run_id] = (name, time.perf_counter())
+    
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+    
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+    
+    def _finish(self, run_id):
+        if run_id in self.started:
+            name, start = self.started.pop(run_id)
+            self.latencies[name].append(time.perf_counter() - start)
+
+def check_sample_types(index, row):
+    """Reject values the string schema would otherwise silently cast"""
+    for col in ('question', 'answer', 'ground_truth'):
+        value = row[col]
+        if not isinstance(value, str) and not (col == 'ground_truth' and value is None):
+            raise ValueError(
+                f"Row {index}: {col} must be a string, got {type(value).__name__}"
+            )
+    contexts = row['contexts']
+    if not (isinstance(contexts, list) and all(isinstance(c, str) for c in contexts)):
+        raise ValueError(f"Row {index}: contexts must be a list of strings")
+
+def iter_evaluation_samples(file_path):
+    """Yield evaluation samples one at a time without loading the whole file"""
+    # One cursor per column, so rows can be zipped back together while streaming.
+    # Each cursor scans the whole file, but a single pass would have to buffer
+    # every earlier column until the last one is reached.
+    # Raw unbuffered bytes: ijson reads READ_BUFFER_SIZE chunks straight from
+    # the fd and validates UTF-8 itself, so no BufferedReader or text codec
+    files = [open(file_path, 'rb', buffering=0) for _ in FIELDS]
+    try:
+        columns = [ijson.items(f, f"{key}.item", buf_size=READ_BUFFER_SIZE)
+                   for f, key in zip(files, FIELDS)]
+        has_ground_truths = None
+        for index, values in enumerate(zip_longest(*columns, fillvalue=MISSING)):
+            row = dict(zip(FIELDS.values(), values))
+            
+            # ground_truths is optional, but only as a whole
+            if has_ground_truths is None:
+                has_ground_truths = row['ground_truth'] is not MISSING
+            if not has_ground_truths:
+                row['ground_truth'] = None
+            
+            missing = [col for col, value in row.items() if value is MISSING]
+            if missing:
+                raise ValueError(
+                    f"Row {index} has no {', '.join(missing)}: "
+                    f"all columns must have the same length"
+                )
+            check_sample_types(index, row)
+            yield row
+    finally:
+        for f in files:
+            f.close()
 
 def load_evaluation_data(file_path="outputs/evaluation_data.json"):
-    """Load evaluation dataset"""
+    """Locate evaluation dataset for streaming"""
     print(f"📂 Loading evaluation data from {file_path}")
     
-    try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        return data
-    except FileNotFoundError:
+    if not os.path.exists(file_path):
         print(f"❌ File not found: {file_path}")
         return None
+    return file_path
+
+def has_samples(file_path):
+    """Check that the evaluation data has at least one question"""
+    with open(file_path, 'rb') as f:
+        return next(ijson.items(f, 'questions.item'), None) is not None
 
-def prepare_dataset(data):
+def prepare_dataset(file_path, cache_dir):
     """Prepare dataset for RAGAS evaluation"""
     print("\n📋 Preparing dataset for evaluation...")
     
-    dataset = Dataset.from_dict({
-        'question': data.get('questions', []),
-        'answer': data.get('answers', []),
-        'contexts': data.get('contexts', []),
-        'ground_truth': data.get('ground_truths', [])
-    })
+    # datasets would only report an empty file as a missing "train" split
+    if not has_samples(file_path):
+        print(f"❌ No samples found in {file_path}")
+        return None
+    
+    # Streaming keeps memory flat while the file is read and the Arrow table
+    # is built; RAGAS still holds every row in memory during evaluate().
+    # Rows are written to the caller's scratch cache_dir, so no copy is
+    # left behind in ~/.cache/huggingface
+    try:
+        dataset = Dataset.from_generator(
+            iter_evaluation_samples,
+            features=FEATURES,
+            cache_dir=cache_dir,
+            gen_kwargs={'file_path': file_path}
+        )
+    except DatasetGenerationError as e:
+        # datasets hides the generator's ValueError behind a generic message
+        print(f"❌ Invalid evaluation data: {e.__cause__ or e}")
+        return None
     
     print(f"✅ Dataset prepared with {len(dataset)} samples")
     return dataset
@@ -47,7 +257,7 @@ def prepare_dataset(data):
 def run_evaluation(dataset):
     """Run RAGAS evaluation"""
     print("\n🔄 Running RAGAS evaluation...")
-    print("This may take a few minutes...\n")
+    print(f"This may take a few minutes ({MAX_WORKERS} concurrent workers)...\n")
     
     metrics = [
         faithfulness,
@@ -59,28 +269,84 @@ def run_evaluation(dataset):
         answer_correctness
     ]
     
+    # Without any ground truths these metrics only burn LLM calls on NaNs.
+    # Checked on the Arrow column so it is not pulled into a Python list
+    longest_ground_truth = pc.max(pc.utf8_length(dataset.data.column('ground_truth')))
+    if not longest_ground_truth.as_py():
+        skipped = ', '.join(metric.name for metric in REFERENCE_METRICS)
+        print(f"⚠️  No ground truths found, skipping: {skipped}\n")
+        metrics = [metric for metric in metrics if metric not in REFERENCE_METRICS]
+    
+    run_config = RunConfig(
+        max_workers=MAX_WORKERS,
+        timeout=180
+    )
+    
+    # answer_similarity and answer_correctness both embed each row's answer
+    # and ground truth, so share one cache between the embedding metrics.
+    # evaluate() wraps this in another LangchainEmbeddingsWrapper whose
+    # set_run_config never reaches the OpenAI client, so the run config is
+    # applied here when the inner client is built
+    embeddings = CachedEmbeddings(embedding_factory(run_config=run_config))
+    
+    latency_callback = MetricLatencyCallback(metric.name for metric in metrics)
+    
     try:
         results = evaluate(
             dataset=dataset,
             metrics=metrics,
+            embeddings=embeddings,
+            callbacks=[latency_callback],
+            run_config=run_config,
             raise_exceptions=False
         )
+        print_metric_latencies(latency_callback)
         return results
     except Exception as e:
         print(f"❌ Error during evaluation: {e}")
         return None
 
-def save_results(results, output_file="outputs/evaluation_results.json"):
+def print_metric_latencies(callback):
+    """Print per-metric latency, slowest first"""
+    print("\n⏱️  Metric Latency (seconds per sample):")
+    print("-" * 60)
+    
+    latencies = {name: np.asarray(values) for name, values in callback.latencies.items()}
+    for name, values in sorted(latencies.items(), key=lambda item: -item[1].mean()):
+        p50, p99 = np.percentile(values, [50, 99])
+        print(f"  {name:25} → Mean: {values.mean():.2f}  p50: {p50:.2f}  p99: {p99:.2f}")
+
+def metric_stats(df, metrics_cols):
+    """Compute mean and std for each metric column"""
+    # One reduction over all metric columns instead of mean()/std() per column
+    return df[metrics_cols].agg(['mean', 'std'])
+
+def save_results(results, output_file="outputs/evaluation_results.parquet",
+                 summary_file="outputs/evaluation_summary.json"):
     """Save evaluation results"""
     print(f"\n💾 Saving results to {output_file}")
     
-    # Convert results to JSON
-    results_dict = results.to_dict()
+    df = results.to_pandas()
+    
+    # Per-sample results go to Parquet as columnar buffers; scores only
+    # need a few decimals, so store them as float32 rather than float64
+    float_cols = df.select_dtypes('float64').columns
+    stored = df.astype({col: np.float32 for col in float_cols})
+    table = pa.Table.from_pandas(stored, preserve_index=False)
+    pq.write_table(table, output_file, compression='zstd', use_dictionary=True)
     
-    with open(output_file, 'w') as f:
-        json.dump(results_dict, f, indent=2)
+    # Keep a small JSON summary for quick inspection
+    metrics_cols = [col for col in df.columns if col not in FIELDS.values()]
+    summary = metric_stats(df, metrics_cols).to_dict()
     
-    print(f"✅ Results saved to {output_file}")
+    # OPT_SERIALIZE_NUMPY handles the numpy scalars pandas returns
+    with open(summary_file, 'wb') as f:
+        f.write(orjson.dumps(
+            summary,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+        ))
+    
+    print(f"✅ Results saved to {output_file} (summary: {summary_file})")
 
 def print_summary(results):
     """Print evaluation summary"""
@@ -97,21 +363,33 @@ def print_summary(results):
     
     metrics_cols = ['faithfulness', 'answer_relevancy', 'context_precision', 
                     'context_recall', 'answer_correctness']
+    metrics_cols = [col for col in metrics_cols if col in df.columns]
     
-    for col in metrics_cols:
-        if col in df.columns:
-            mean = df[col].mean()
-            std = df[col].std()
-            print(f"  {col:25} → Mean: {mean:.4f} (±{std:.4f})")
+    stats = metric_stats(df, metrics_cols)
+    for col, (mean, std) in stats.items():
+        print(f"  {col:25} → Mean: {mean:.4f} (±{std:.4f})")
     
     print("\n" + "="*60)
     
     # Print per-sample results
     print("\n📝 Per-Sample Results:")
     print("-" * 60)
-    print(df[metrics_cols].round(4).to_string())
+    # Format while writing instead of building a rounded copy first
+    print(df[metrics_cols].to_string(float_format=lambda x: f"{x:.4f}"))
     print("\n" + "="*60)
 
+def print_data_format():
+    """Print the expected evaluation data format"""
+    print("\n💡 To run evaluation:")
+    print("1. Generate Q&A responses from your RAG system")
+    print("2. Save results to outputs/evaluation_data.json with format:")
+    print("   {")
+    print('       "questions": [...],')
+    print('       "answers": [...],')
+    print('       "contexts": [...],')
+    print('       "ground_truths": [...]')
+    print("   }")
+
 def main():
     """Main evaluation function"""
     print("="*60)
@@ -119,32 +397,29 @@ def main():
     print("="*60)
     
     # Load data
-    data = load_evaluation_data()
-    if data is None:
-        print("\n💡 To run evaluation:")
-        print("1. Generate Q&A responses from your RAG system")
-        print("2. Save results to outputs/evaluation_data.json with format:")
-        print("   {")
-        print('       "questions": [...],')
-        print('       "answers": [...],')
-        print('       "contexts": [...],')
-        print('       "ground_truths": [...]')
-        print("   }")
-        return
-    
-    # Prepare dataset
-    dataset = prepare_dataset(data)
-    
-    # Run evaluation
-    results = run_evaluation(dataset)
-    if results is None:
+    data_file = load_evaluation_data()
+    if data_file is None:
+        print_data_format()
         return
     
-    # Save results
-    save_results(results)
-    
-    # Print summary
-    print_summary(results)
+    # Scratch HF datasets cache, removed when the run is over
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as cache_dir:
+        # Prepare dataset
+        dataset = prepare_dataset(data_file, cache_dir)
+        if dataset is None:
+            print_data_format()
+            return
+        
+        # Run evaluation
+        results = run_evaluation(dataset)
+        if results is None:
+            return
+        
+        # Save results
+        save_results(results)
+        
+        # Print summary
+        print_summary(results)
 
 if __name__ == "__main__":
     main()
@@ -6,19 +6,71 @@ Creates IAM roles, OpenSearch Serverless collection, and S3 bucket
 
 import boto3
 import json
+import os
+import random
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-# Initialize clients
-iam_client = boto3.client('iam')
-aoss_client = boto3.client('opensearchserverless')
-s3_client = boto3.client('s3')
-sts_client = boto3.client('sts')
+# Room for the concurrent setup calls, with adaptive backoff on throttling
+client_config = Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    connect_timeout=5,
+    read_timeout=60
+)
+
+# Initialize clients from one session so credentials are resolved once
+session = boto3.Session()
+iam_client = session.client('iam', config=client_config)
+aoss_client = session.client('opensearchserverless', config=client_config)
+s3_client = session.client('s3', config=client_config)
+sts_client = session.client('sts', config=client_config)
+
+# Set when a concurrent setup step fails, so the others stop early
+setup_failed = threading.Event()
+
+# Policy documents are static, so encode them once at import
+ASSUME_ROLE_POLICY_JSON = json.dumps({
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Principal": {
+                "Service": "bedrock.amazonaws.com"
+            },
+            "Action": "sts:AssumeRole"
+        }
+    ]
+})
+
+KB_POLICY_JSON = json.dumps({
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "bedrock:*",
+                "aoss:*",
+                "s3:GetObject",
+                "s3:ListBucket",
+                "s3:PutObject",
+                "s3:DeleteObject"
+            ],
+            "Resource": "*"
+        }
+    ]
+})
 
 def get_account_id():
     """Get AWS Account ID"""
     try:
-        account_id = sts_client.get_caller_identity()['Account']
+        # Skip the STS round-trip when the account is already known
+        account_id = (os.environ.get('AWS_ACCOUNT_ID')
+                      or sts_client.get_caller_identity()['Account'])
         print(f"✅ AWS Account ID: {account_id}")
         return account_id
     except Exception as e:
@@ -29,23 +81,10 @@ def create_iam_role(role_name="bedrock-kb-role"):
     """Create IAM role for Bedrock Knowledge Base"""
     print(f"\n📋 Creating IAM Role: {role_name}")
     
-    assume_role_policy = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Principal": {
-                    "Service": "bedrock.amazonaws.com"
-                },
-                "Action": "sts:AssumeRole"
-            }
-        ]
-    }
-    
     try:
         response = iam_client.create_role(
             RoleName=role_name,
-            AssumeRolePolicyDocument=json.dumps(assume_role_policy),
+            AssumeRolePolicyDocument=ASSUME_ROLE_POLICY_JSON,
             Description='Role for Bedrock Knowledge Base'
         )
         role_arn = response['Role']['Arn']
@@ -64,35 +103,30 @@ def attach_policies(role_name):
     """Attach policies to IAM role"""
     print(f"\n📋 Attaching policies to {role_name}")
     
-    policy_document = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Action": [
-                    "bedrock:*",
-                    "aoss:*",
-                    "s3:GetObject",
-                    "s3:ListBucket",
-                    "s3:PutObject",
-                    "s3:DeleteObject"
-                ],
-                "Resource": "*"
-            }
-        ]
-    }
-    
     try:
         iam_client.put_role_policy(
             RoleName=role_name,
             PolicyName='bedrock-kb-policy',
-            PolicyDocument=json.dumps(policy_document)
+            PolicyDocument=KB_POLICY_JSON
         )
         print(f"✅ Policies attached")
     except Exception as e:
         print(f"❌ Error: {e}")
         sys.exit(1)
 
+def abort_if_setup_failed(step):
+    """Stop a setup step once another one has failed"""
+    if setup_failed.is_set():
+        print(f"⚠️  Skipping {step}: another setup step failed")
+        sys.exit(1)
+
+def setup_iam_role(role_name="bedrock-kb-role"):
+    """Create IAM role and attach its policies"""
+    role_arn = create_iam_role(role_name)
+    abort_if_setup_failed("policy attachment")
+    attach_policies(role_arn.split('/')[-1])
+    return role_arn
+
 def create_aoss_collection(collection_name="bedrock-kb-collection"):
     """Create OpenSearch Serverless collection"""
     print(f"\n📋 Creating AOSS Collection: {collection_name}")
@@ -117,10 +151,68 @@ def create_aoss_collection(collection_name="bedrock-kb-collection"):
             print(f"❌ Error: {e}")
             sys.exit(1)
 
+def wait_for_collection_active(collection_name, timeout=600):
+    """Poll AOSS collection until it is ACTIVE"""
+    print(f"\n⏳ Waiting for AOSS Collection to become ACTIVE: {collection_name}")
+    
+    delay = 2
+    last_error = None
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = aoss_client.batch_get_collection(names=[collection_name])
+        except ClientError as e:
+            print(f"❌ Error: {e}")
+            sys.exit(1)
+        
+        # Right after creation the name may not resolve yet and is reported
+        # under collectionErrorDetails instead; keep polling until timeout
+        details = response.get('collectionDetails', [])
+        if not details:
+            last_error = response.get('collectionErrorDetails')
+        status = details[0]['status'] if details else None
+        
+        if status == 'ACTIVE':
+            print(f"✅ Collection active: {collection_name}")
+            return
+        if status == 'FAILED':
+            print(f"❌ Collection creation failed: {collection_name}")
+            sys.exit(1)
+        
+        # Exponential backoff with jitter, capped at 30s; wakes up early
+        # if another setup step fails
+        if setup_failed.wait(delay + random.random()):
+            print(f"⚠️  Stopped waiting for collection: another setup step failed")
+            sys.exit(1)
+        delay = min(delay * 1.5, 30)
+    
+    print(f"❌ Timed out after {timeout}s waiting for collection: {collection_name}")
+    if last_error:
+        print(f"   Last lookup error: {last_error}")
+    sys.exit(1)
+
+def setup_aoss_collection(collection_name="bedrock-kb-collection"):
+    """Create OpenSearch Serverless collection and wait until it is usable"""
+    collection_arn = create_aoss_collection(collection_name)
+    abort_if_setup_failed("AOSS collection wait")
+    wait_for_collection_active(collection_name)
+    return collection_arn
+
 def create_s3_bucket(bucket_name):
     """Create S3 bucket for documents"""
     print(f"\n📋 Creating S3 Bucket: {bucket_name}")
     
+    # Re-runs usually find the bucket already there; a HEAD is cheaper
+    # than a failing create_bucket PUT
+    try:
+        s3_client.head_bucket(Bucket=bucket_name)
+        print(f"⚠️  Bucket already exists: {bucket_name}")
+        return bucket_name
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchBucket'):
+            print(f"❌ Error: {e}")
+            sys.exit(1)
+    
     try:
         s3_client.create_bucket(
             Bucket=bucket_name,
@@ -145,19 +237,31 @@ def main():
     # Get account ID
     account_id = get_account_id()
     
-    # Create IAM role
-    role_arn = create_iam_role()
-    role_name = role_arn.split('/')[-1]
+    bucket_name = f"bedrock-kb-documents-{account_id}"
     
-    # Attach policies
-    attach_policies(role_name)
+    # IAM role, AOSS collection and S3 bucket do not depend on each other,
+    # so overlap their network round-trips and the AOSS provisioning wait.
+    # Unlike running them in sequence, a failure in one step can leave
+    # resources from the others behind; use cleanup.sh to remove them.
+    executor = ThreadPoolExecutor(max_workers=3)
+    role_future = executor.submit(setup_iam_role)
+    aoss_future = executor.submit(setup_aoss_collection)
+    s3_future = executor.submit(create_s3_bucket, bucket_name)
     
-    # Create AOSS collection
-    aoss_arn = create_aoss_collection()
+    try:
+        for future in as_completed([role_future, aoss_future, s3_future]):
+            future.result()
+    except BaseException:
+        # Tell the other steps to stop at their next checkpoint and exit
+        # without joining them; calls already in flight still complete
+        setup_failed.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
     
-    # Create S3 bucket
-    bucket_name = f"bedrock-kb-documents-{account_id}"
-    s3_bucket = create_s3_bucket(bucket_name)
+    role_arn = role_future.result()
+    aoss_arn = aoss_future.result()
+    s3_bucket = s3_future.result()
     
     # Print summary
     print("\n" + "="*60)